@@ -1,9 +1,15 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
 from src import enrich_utils
 from src import map2trgt_utils
 from src import stat_utils
 from src import plot_utils
 from src import parse_utils
 from src import citation_handler
+from src import cluster_utils
 from src.build_corrmat import check_corrmat
 
 __author__ = 'Rasmus Magnusson'
@@ -21,7 +27,8 @@ class TFTenricher:
                  TFs,
                  mapmethod='corr',
                  silent=False,
-                 top_n_genes=None):
+                 top_n_genes=None,
+                 prefetch=None):
         """
         The transcription factor downstream annotation enricher (TFTenricher)
         package is a bioinformatics tool to enable users to do an enrichment
@@ -48,11 +55,22 @@ class TFTenricher:
             top_n_genes. The default is None, equaling to include all genes
             returned from the mapmethod.
 
+        prefetch : str, list or None, optional
+            Gene-set libraries, e.g. ['GO', 'KEGG'], to start loading in a
+            background thread while the TFs are mapped to target genes. Once
+            loaded, and the gene order of the mapping is known, they are also
+            compiled in the background. TFTenricher.downstream_enrich then
+            only waits for whatever is left. The default is None, i.e. load
+            on demand.
+
 
         Attributes
         -------
         target_genes : The estimated target genes.
 
+        TFs can later be added or removed with TFTenricher.add_tfs and
+        TFTenricher.remove_tfs.
+
 
         How to cite
         -------
@@ -74,27 +92,83 @@ class TFTenricher:
         # Attributes that will be filled in other methods
         self.enrichments = None
         self.multtest_fun = None
+        self.FDR = None
+        self.method = None
+        self.n_workers = 1
+
+        # State for incremental updates with add_tfs and remove_tfs
+        self.top_n_genes = top_n_genes
+        self._scores = None
+        self._cutoffs = {}
+        self._gene_lists = None
+        self._library = None
+        self._overlaps = None
+        # Arguments of the last reduce_redundancy, re-applied on TF updates
+        self._redundancy = None
+
+        # Start loading the gene-set libraries before the (independent) TF to
+        # target mapping, so that the two overlap
+        self._prefetched = {}
+        self._precompiled = {}
+        executor = None
+        if prefetch is not None:
+            if isinstance(prefetch, str):
+                prefetch = [prefetch]
+            executor = ThreadPoolExecutor(max_workers=len(prefetch))
+            for db in prefetch:
+                self._prefetched[db.upper()] = executor.submit(
+                    enrich_utils._load_gene_lists, db.upper())
 
 
         if mapmethod == 'corr':
             # If corr matrix does not exist, build it
             check_corrmat()
 
+            # With the gene order of the correlation matrix known, compile the
+            # libraries while the TFs are scored and thresholded
+            if executor is not None:
+                self._precompile(executor,
+                                 map2trgt_utils._load_corr(silent=silent).columns)
+                executor.shutdown(wait=False)
+
             self.mapmethod = map2trgt_utils.correlation_genes
             self.used_methods.append('corrs')
+
+            self.target_genes, self._scores = self.mapmethod(
+                TFs,
+                silent=silent,
+                top_n_genes=top_n_genes,
+                return_scores=True,
+                cutoffs=self._cutoffs,
+                )
         else:
+            if executor is not None:
+                self._precompile(executor, None)
+                executor.shutdown(wait=False)
+
             self.mapmethod = mapmethod
 
-        self.target_genes = self.mapmethod(TFs,
-                                           silent=silent,
-                                           top_n_genes=top_n_genes
-                                           )
+            self.target_genes = self.mapmethod(TFs,
+                                               silent=silent,
+                                               top_n_genes=top_n_genes
+                                               )
 
 
+    def _precompile(self, executor, genes):
+        def compile_library(db, loaded):
+            return enrich_utils._get_library(db, genes=genes, gene_lists=loaded.result())
+
+        for db in self._prefetched:
+            self._precompiled[db] = executor.submit(compile_library,
+                                                    db,
+                                                    self._prefetched[db])
+
     def downstream_enrich(self,
                           db='GO',
                           FDR=0.05,
                           multiple_testing_correction='BenjaminiHochberg',
+                          method='fisher',
+                          n_workers=1,
                           ):
         """
 
@@ -107,7 +181,9 @@ class TFTenricher:
             genes as elements, e.g. {'annot' : ['gene1', 'gene2'}. Here, the
             gene names are in the SYMBOL id. Note that, in the case of 'db'
             being a dict, TFTenricher.downstream_enrich by default removes
-            annotations with fewer target genes than 10.
+            annotations with fewer target genes than 10. Large dicts that
+            are queried repeatedly can be compiled once with
+            enrich_utils.compile_library, and the result given as 'db'.
             The default is 'GO'.
 
         FDR : float, optional
@@ -120,15 +196,38 @@ class TFTenricher:
             please see the github page or
            stat_utils.benjaminihochberg_correction, which is also the default
 
+        method : {'fisher', 'preranked'}, optional
+            'fisher' tests the overlap of the target genes with each
+            annotation by a Fisher exact test. 'preranked' instead uses the
+            continuous target scores of all genes, without a cut-off, and
+            tests whether the genes of each annotation score higher than
+            other genes by a Mann-Whitney U test. The effect size is then
+            given as 'AUC' instead of 'OR'. 'preranked' is only available with
+            mapmethod='corr'. The default is 'fisher'.
+
+        n_workers : int, optional
+            Number of threads for very large gene-set libraries, e.g. custom
+            dicts with 100k+ annotations. These are split into shards of
+            annotations that are scored in parallel. The thread pool and the
+            shards are reused across calls. The default is 1.
+
         Attributes
         -------
         enrichments : pandas DataFrame of the results, with annotation, P-value
         and a bool value of whether the test passed a multiple testing
-        correction
+        correction. With the built-in corrections, the adjusted p-values are
+        given in the column 'q'
 
         """
 
+        if method not in ['fisher', 'preranked']:
+            raise ValueError('method should be either "fisher" or "preranked"')
+        if (method == 'preranked') and (self._scores is None):
+            raise ValueError('method="preranked" is only available with mapmethod="corr"')
+
         self.db = db
+        self.method = method
+        self.n_workers = n_workers
         if multiple_testing_correction == 'BenjaminiHochberg': # use this unless otherwise told
             self.multtest_fun = stat_utils.benjaminihochberg_correction
         elif multiple_testing_correction == 'Bonferroni':
@@ -141,13 +240,266 @@ class TFTenricher:
             db = db.upper()
             self.used_methods.append(db)
 
+        self.FDR = FDR
+        if isinstance(db, str) and db in self._prefetched:
+            self._gene_lists = self._prefetched[db].result()
+            # The compiled library is then cached, for the same gene order
+            self._precompiled[db].result()
+        else:
+            self._gene_lists = enrich_utils._load_gene_lists(db)
+        # Compiled once per library, with the scored genes first so that
+        # their positions match self._scores
+        genes = None if self._scores is None else self._scores.index
+        if enrich_utils._is_library(db) and (method == 'fisher'):
+            # Any gene order works for the overlaps
+            genes = None
+        self._library = enrich_utils._get_library(db,
+                                                  genes=genes,
+                                                  gene_lists=self._gene_lists)
+        self._overlaps = None
+        self._redundancy = None
+        if method == 'fisher':
+            target_idx, _ = enrich_utils._encode_genes(self._library,
+                                                       self.target_genes)
+            self._overlaps = enrich_utils._overlap_core(self._library, target_idx)
+
+        self._set_enrichments()
+
+    def _set_enrichments(self):
+        if self.method == 'preranked':
+            # As for the target genes, the input TFs are not scored
+            keep = ~self._scores.index.isin(self.TFs)
+            membership = self._library['membership'][:, :len(keep)][:, keep]
+            res = enrich_utils.set_preranked_enrichments(
+                self._scores[keep],
+                mult_test_corr=self.multtest_fun,
+                FDR=self.FDR,
+                membership=(membership,
+                            self._library['terms'],
+                            self._library['set_sizes']),
+                )
+            self.enrichments = res
+            return
+
         res = enrich_utils.set_enrichments(self.target_genes,
                                            mult_test_corr=self.multtest_fun,
-                                           db=db,
-                                           FDR=FDR,
+                                           FDR=self.FDR,
+                                           overlaps=self._overlaps,
+                                           library=self._library,
+                                           n_workers=self.n_workers,
                                            )
         self.enrichments = res
 
+    def add_tfs(self, TFs):
+        """
+        Add TFs to the analysis without recomputing the mapping from scratch.
+        The summed correlation is updated with the rows of the new TFs only,
+        and the target genes are re-thresholded. If downstream_enrich has been
+        run, the enrichments are refreshed with updated overlap counts. If
+        TFTenricher.reduce_redundancy has been run, the terms are re-clustered
+        with the same arguments.
+
+        Only available with mapmethod='corr'.
+
+        Parameters
+        ----------
+        TFs : list
+            TFs to add. TFs already in the analysis are ignored.
+
+        """
+        new_TFs = [tf for tf in TFs if tf not in self.TFs]
+        self._update_tfs(new_TFs, sign=1)
+
+    def remove_tfs(self, TFs):
+        """
+        Remove TFs from the analysis, the inverse of TFTenricher.add_tfs.
+
+        Parameters
+        ----------
+        TFs : list
+            TFs to remove. TFs not in the analysis are ignored.
+
+        """
+        old_TFs = [tf for tf in TFs if tf in self.TFs]
+        self._update_tfs(old_TFs, sign=-1)
+
+    def _update_tfs(self, TFs, sign):
+        if self._scores is None:
+            raise ValueError('add_tfs and remove_tfs are only available with mapmethod="corr"')
+        if len(TFs) == 0:
+            return
+
+        if sign == 1:
+            new_TFs = list(self.TFs) + list(TFs)
+        else:
+            new_TFs = [tf for tf in self.TFs if tf not in TFs]
+
+        # Threshold before committing any state, so that a failed update
+        # (e.g. no TFs left in the correlation matrix) leaves the object as is
+        scores = map2trgt_utils.update_correlation_scores(self._scores,
+                                                          TFs,
+                                                          sign=sign)
+        target_genes = map2trgt_utils._threshold_scores(
+            scores,
+            new_TFs,
+            top_n_genes=self.top_n_genes,
+            cutoffs=self._cutoffs,
+            )
+
+        old_targets = self.target_genes
+        self.TFs = new_TFs
+        self._scores = scores
+        self.target_genes = target_genes
+
+        if self.enrichments is None:
+            return
+        if self.method == 'fisher':
+            added, _ = enrich_utils._encode_genes(self._library,
+                                                  np.setdiff1d(target_genes, old_targets))
+            removed, _ = enrich_utils._encode_genes(self._library,
+                                                    np.setdiff1d(old_targets, target_genes))
+            self._overlaps = enrich_utils._update_overlap_core(self._library,
+                                                               self._overlaps,
+                                                               added_idx=added,
+                                                               removed_idx=removed)
+        self._set_enrichments()
+
+        # The new enrichments have no clusters, so cluster them again
+        if self._redundancy is not None:
+            self.reduce_redundancy(**self._redundancy)
+
+    def reduce_redundancy(self,
+                          similarity='jaccard',
+                          cutoff=0.5,
+                          on='genes',
+                          method='exact',
+                          only_FDR=True,
+                          ):
+        """
+        Cluster redundant, overlapping terms in TFTenricher.enrichments. Each
+        cluster is represented by its most significant term.
+
+        Parameters
+        ----------
+        similarity : {'jaccard', 'overlap'}, optional
+            Jaccard index, or overlap coefficient, of the genes of two terms.
+            The default is 'jaccard'.
+
+        cutoff : float, optional
+            The similarity at which terms are clustered. The default is 0.5.
+
+        on : {'genes', 'targets'}, optional
+            Compare terms on all their member genes, or only on their overlap
+            with the target genes. The default is 'genes'.
+
+        method : {'exact', 'minhash'}, optional
+            Exact similarities, or MinHash estimates for very large
+            libraries. The default is 'exact'.
+
+        only_FDR : bool, optional
+            Only cluster terms that passed the multiple testing correction.
+            The default is True.
+
+        Attributes
+        -------
+        enrichments : the columns 'cluster' and 'representative' are added.
+
+        """
+        if self.enrichments is None:
+            raise ValueError('Run TFTenricher.downstream_enrich first')
+        if on not in ['genes', 'targets']:
+            raise ValueError('on should be either "genes" or "targets"')
+
+        self.enrichments = cluster_utils.cluster_terms(
+            self.enrichments,
+            self._gene_lists,
+            target_genes=self.target_genes if on == 'targets' else None,
+            similarity=similarity,
+            cutoff=cutoff,
+            method=method,
+            only_FDR=only_FDR,
+            )
+        self._redundancy = {'similarity': similarity,
+                            'cutoff': cutoff,
+                            'on': on,
+                            'method': method,
+                            'only_FDR': only_FDR,
+                            }
+
+    def leave_one_out(self, only_FDR=False):
+        """
+        Leave-one-out influence analysis of the TFs on the enrichments. Each
+        TF is left out in turn, and the enrichments of the terms in
+        TFTenricher.enrichments are recalculated for all TFs at once.
+
+        Only available with mapmethod='corr', and after
+        TFTenricher.downstream_enrich with method='fisher'.
+
+        Parameters
+        ----------
+        only_FDR : bool, optional
+            If True, only include the terms that passed the multiple testing
+            correction. Requires that downstream_enrich was run with a
+            multiple testing correction. The default is False.
+
+        Returns
+        -------
+        dlogp : pandas DataFrame
+            TFs x terms matrix of the drop in -log10 p when the TF is left
+            out. Positive values mean that the TF drives the enrichment.
+
+        dOR : pandas DataFrame
+            TFs x terms matrix of the drop in odds ratio when the TF is left
+            out. The odds ratio is infinite when no genes of a term are
+            outside the targets, or no targets are outside the term, so dOR
+            is then +-inf, or nan if both odds ratios are infinite.
+
+        contributions : pandas DataFrame
+            TFs x target genes matrix of the fraction of the score of each
+            target gene that comes from each TF.
+
+        """
+        if self._scores is None:
+            raise ValueError('leave_one_out is only available with mapmethod="corr"')
+        if self.enrichments is None:
+            raise ValueError('Run TFTenricher.downstream_enrich first')
+        if self.method == 'preranked':
+            # The Fisher deltas would not describe the AUC enrichments
+            raise ValueError('leave_one_out is only available after downstream_enrich with method="fisher"')
+
+        terms = self.enrichments.index
+        if only_FDR:
+            if 'FDR' not in self.enrichments.columns:
+                raise ValueError('only_FDR=True requires a multiple testing correction in downstream_enrich')
+            terms = terms[self.enrichments.FDR.values.astype(bool)]
+
+        loo_targets, contributions = map2trgt_utils.leave_one_out_targets(
+            self._scores,
+            self.TFs,
+            top_n_genes=self.top_n_genes,
+            cutoffs=self._cutoffs,
+            )
+
+        # The full TF set is scored the same way, to compare like with like.
+        # The compiled library of downstream_enrich is reused
+        full = self._scores.index.isin(self.target_genes)
+        targets = pd.concat([
+            pd.DataFrame(full[None, :], index=['all'], columns=self._scores.index),
+            loo_targets,
+            ])
+        OR, p = enrich_utils.enrichment_matrix(targets,
+                                               self._library,
+                                               terms=terms)
+        logp = -np.log10(p)
+
+        dlogp = logp.iloc[0, :] - logp.iloc[1:, :]
+        dOR = OR.iloc[0, :] - OR.iloc[1:, :]
+
+        in_targets = contributions.columns.isin(self.target_genes)
+        contributions = contributions.loc[:, in_targets]
+        contributions = contributions/self._scores[in_targets]
+        return dlogp, dOR, contributions
+
     def plot(self,
              savename=None,
              plot_Ntop='all',
@@ -224,12 +576,17 @@ if __name__ == '__main__':
     with open(args.tfs[0], 'r') as f:
         TFs = f.read().strip('\n').split(args.sep[0])
 
-    # Map TFs to targets
-    enr = TFTenricher(TFs, silent=args.silent, top_n_genes=args.ngenes)
+    db = args.db if isinstance(args.db, str) else args.db[0]
+
+    # Map TFs to targets, while the gene sets are loaded in the background
+    enr = TFTenricher(TFs,
+                      silent=args.silent,
+                      top_n_genes=args.ngenes,
+                      prefetch=db)
 
     # Calculate the overlaps between putative downstream genes and gene sets
     enr.downstream_enrich(
-        db=args.db,
+        db=db,
         FDR=args.FDR,
         multiple_testing_correction=args.multiple_test_corr
         )
@@ -0,0 +1,43 @@
+from src import parse_utils
+from src import shard_utils
+
+__author__ = 'Rasmus Magnusson'
+__COPYRIGHT__ = 'Copyright (C) 2021 Rasmus Magnusson'
+__contact__ = 'rasma774@gmail.com'
+__LICENSE__ = 'GNU Affero General Public License v3.0'
+
+
+if __name__ == '__main__':
+    args = parse_utils.parse_shard()
+    shard_dir = args.shard_dir[0]
+
+    if args.command == 'coordinate':
+        jobs = shard_utils.read_manifest(args.manifest[0], sep=args.sep[0])
+        nshards = shard_utils.write_shards(
+            jobs,
+            shard_dir,
+            shard_size=args.shard_size[0],
+            db=args.db,
+            FDR=args.FDR[0],
+            multiple_test_corr=args.multiple_test_corr[0],
+            ngenes=args.ngenes[0],
+            overwrite=args.overwrite,
+            )
+        print(str(len(jobs)) + ' jobs written to ' + str(nshards) + ' shards')
+
+    elif args.command == 'work':
+        nrun = shard_utils.work(shard_dir,
+                                worker_id=args.worker_id[0],
+                                lease=args.lease[0])
+        print(str(nrun) + ' shards run')
+
+    elif args.command == 'requeue':
+        nrequeued = shard_utils.requeue(shard_dir, lease=args.lease[0])
+        print(str(nrequeued) + ' shards requeued')
+
+    elif args.command == 'merge':
+        res, missing = shard_utils.merge(shard_dir,
+                                         savename=args.results_savename[0],
+                                         rerun=not args.no_rerun)
+        if len(missing) > 0:
+            print('No results for jobs: ' + ', '.join(missing))
@@ -0,0 +1,106 @@
+"""
+Per-query latency of TFTenricher in a warm process, i.e. with the
+correlation matrix and gene-set libraries already loaded.
+
+Run from this folder:
+    python benchmark_latency.py
+
+If the correlation matrix has not been built, only the enrichment step is
+timed, on random target gene sets. The full query assumes that the null
+cutoff table has been built (python -m src.build_corrmat), since the Monte
+Carlo estimate otherwise dominates.
+
+The first query of a process is also timed from cold caches, with the
+gene-set library loaded and compiled either after the TF mapping, or in the
+background while the TFs are mapped (prefetch).
+"""
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from src import enrich_utils
+from src import map2trgt_utils
+from src import stat_utils
+
+__author__ = 'Rasmus Magnusson'
+__COPYRIGHT__ = 'Copyright (C) 2021 Rasmus Magnusson'
+__contact__ = 'rasma774@gmail.com'
+
+NREPEATS = 50
+
+
+def _time(fun, nrepeats=NREPEATS):
+    fun()  # warm up
+    times = []
+    for _ in range(nrepeats):
+        t0 = time.perf_counter()
+        fun()
+        times.append(time.perf_counter() - t0)
+    return 1000*np.median(times), 1000*np.percentile(times, 95)
+
+def _report(name, times):
+    print(name.ljust(45) + '%8.2f ms (median) %8.2f ms (95th)' % times)
+
+def _clear_caches():
+    # As in a new process, except for the null cutoff table
+    enrich_utils._gene_lists_cache.clear()
+    enrich_utils._libraries.clear()
+    map2trgt_utils._corr = None
+    map2trgt_utils._tf_col = None
+
+def _time_cold(fun, nrepeats=3):
+    times = []
+    for _ in range(nrepeats):
+        _clear_caches()
+        t0 = time.perf_counter()
+        fun()
+        times.append(time.perf_counter() - t0)
+    return 1000*np.median(times)
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+
+    print('Enrichment only, random target genes')
+    for db in ['GO', 'KEGG', 'REACTOME', 'GWAS']:
+        gene_lists = enrich_utils._load_gene_lists(db)
+        universe = enrich_utils._universe(gene_lists)
+        for ngenes in [50, 500]:
+            genes = rng.choice(universe, ngenes, replace=False)
+            times = _time(lambda: enrich_utils.set_enrichments(
+                genes,
+                mult_test_corr=stat_utils.benjaminihochberg_correction,
+                db=db,
+                ))
+            _report(db + ', ' + str(ngenes) + ' genes', times)
+
+    pw = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    if not os.path.isfile(pw + '/data/pickles/correlations.p'):
+        print('\nNo correlation matrix built, skipping the full query')
+        sys.exit()
+
+    from TFTenricher import TFTenricher
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'example_input.txt')) as f:
+        TFs = f.read().strip('\n').split(' ')
+
+    def query():
+        enr = TFTenricher(TFs, silent=True)
+        enr.downstream_enrich(db='GO')
+
+    print('\nFull query, TF mapping and GO enrichment')
+    _report(str(len(TFs)) + ' TFs from example_input.txt', _time(query, nrepeats=10))
+
+    def cold_query(prefetch):
+        enr = TFTenricher(TFs, silent=True, prefetch=prefetch)
+        enr.downstream_enrich(db='GO')
+
+    print('\nFirst query from cold caches, incl. loading the correlation matrix')
+    sequential = _time_cold(lambda: cold_query(None))
+    pipelined = _time_cold(lambda: cold_query('GO'))
+    print('Load and compile GO after the mapping'.ljust(45) + '%8.2f ms (median)' % sequential)
+    print('Prefetch and compile GO during the mapping'.ljust(45) + '%8.2f ms (median)' % pipelined)
+    print('Speedup'.ljust(45) + '%8.2f x' % (sequential/pipelined))
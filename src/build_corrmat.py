@@ -2,6 +2,9 @@ import pandas as pd
 import os
 import os.path
 
+from src import map2trgt_utils
+from src import parse_utils
+
 __author__ = 'Rasmus Magnusson'
 __COPYRIGHT__ = 'Copyright (C) 2021 Rasmus Magnusson'
 __contact__ = 'rasma774@gmail.com'
@@ -19,4 +22,49 @@ def check_corrmat():
             dfs.append(pd.read_pickle(picklepath + pickle_file))
         dfs = pd.concat(dfs).sort_index()
         dfs.to_pickle('/' + PATH + '/data/pickles/correlations.p')
-        print('done')
\ No newline at end of file
+        print('done')
+
+def build_null_table(thresh=0.95, Npermut=map2trgt_utils.NULL_NPERMUT, max_TFs=None, seed=0):
+    """
+    Precompute the null cutoffs of map2trgt_utils.correlation_genes for every
+    number of TFs, and store them next to the correlation matrix. After this,
+    correlation_genes looks the cutoff up instead of estimating it on every
+    call, and gives the same cutoff on every run. Building again with another
+    thresh adds a column to the table.
+
+    Parameters
+    ----------
+    thresh, Npermut, max_TFs, seed :
+        As in map2trgt_utils.null_cutoff_table.
+
+    """
+    check_corrmat()
+    corr = map2trgt_utils._load_corr()
+
+    print('building null cutoff table')
+    cutoffs = map2trgt_utils.null_cutoff_table(corr,
+                                               thresh=thresh,
+                                               Npermut=Npermut,
+                                               max_TFs=max_TFs,
+                                               seed=seed)
+
+    tablepath = '/' + PATH + map2trgt_utils.NULL_TABLE
+    if os.path.isfile(tablepath):
+        table = pd.read_pickle(tablepath)
+        table = table.drop(columns=[thresh], errors='ignore')
+        table = table.join(cutoffs.rename(thresh), how='outer')
+    else:
+        table = pd.DataFrame({thresh: cutoffs})
+    table.to_pickle(tablepath)
+
+    # Let this process use the new table too
+    map2trgt_utils._null_table = table
+    print('done')
+
+
+if __name__ == '__main__':
+    args = parse_utils.parse_null_table()
+    build_null_table(thresh=args.thresh[0],
+                     Npermut=args.Npermut[0],
+                     max_TFs=args.max_TFs[0],
+                     seed=args.seed[0])
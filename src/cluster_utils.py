@@ -0,0 +1,252 @@
+import numpy as np
+import scipy.sparse as sparse
+
+from src import enrich_utils
+
+__author__ = 'Rasmus Magnusson'
+__COPYRIGHT__ = 'Copyright (C) 2021 Rasmus Magnusson'
+__contact__ = 'rasma774@gmail.com'
+
+def _neighbours(i, j, nterms):
+    # Symmetric sparse terms x terms matrix of the similar pairs (i, j)
+    data = np.ones(2*len(i), dtype=bool)
+    return sparse.csr_matrix((data, (np.concatenate([i, j]), np.concatenate([j, i]))),
+                             shape=(nterms, nterms))
+
+def _exact_neighbours(gene_lists, terms, genes, similarity='jaccard', cutoff=0.5, chunksize=2**22):
+    """
+    Pairs of terms with a similarity >= cutoff. The intersections of all
+    pairs are counted by a sparse product of the membership matrix with
+    itself, a chunk of terms at a time, so that only pairs sharing genes are
+    ever compared, and no dense terms x terms matrix is built.
+
+    Parameters
+    ----------
+    similarity : {'jaccard', 'overlap'}, optional
+        Jaccard index, or overlap coefficient |a & b|/min(|a|, |b|). The
+        default is 'jaccard'.
+    cutoff : float, optional
+        The similarity of a pair to be kept. The default is 0.5.
+    chunksize : int, optional
+        Approximate number of intersections to hold at a time. The default is
+        2**22.
+
+    Returns
+    -------
+    Sparse boolean terms x terms matrix of the similar pairs.
+
+    """
+    if similarity not in ['jaccard', 'overlap']:
+        raise ValueError('similarity should be either "jaccard" or "overlap"')
+    membership, _, _ = enrich_utils._membership_matrix(gene_lists,
+                                                       genes,
+                                                       ngenes_thresh=0,
+                                                       terms=terms)
+    # Genes listed twice in a term count once
+    membership.data[:] = 1
+    nterms = membership.shape[0]
+    sizes = np.asarray(membership.sum(1)).ravel()
+    if cutoff <= 0:
+        # All pairs are similar enough
+        i, j = np.triu_indices(nterms, k=1)
+        return _neighbours(i, j, nterms)
+
+    transposed = membership.T.tocsc()
+    pairs_i, pairs_j = [np.array([], dtype=int)], [np.array([], dtype=int)]
+    step = max(1, chunksize//max(1, nterms))
+    for start in range(0, nterms, step):
+        inter = (membership[start:start + step] @ transposed).tocoo()
+        i = inter.row + start
+        j = inter.col
+        if similarity == 'jaccard':
+            sim = inter.data/(sizes[i] + sizes[j] - inter.data)
+        else:
+            sim = inter.data/np.minimum(sizes[i], sizes[j])
+        similar = (sim >= cutoff) & (i < j)
+        pairs_i.append(i[similar])
+        pairs_j.append(j[similar])
+
+    return _neighbours(np.concatenate(pairs_i), np.concatenate(pairs_j), nterms)
+
+def _minhash_neighbours(gene_lists, terms, genes, cutoff=0.5, num_perm=128, bands=None, seed=0):
+    """
+    Pairs of terms with an estimated Jaccard index >= cutoff, from MinHash
+    signatures, for libraries too large to compare all pairs. Candidate pairs
+    are found by locality-sensitive hashing: the signatures are split in
+    bands, and terms that agree on all hashes of any band are compared.
+
+    Parameters
+    ----------
+    cutoff : float, optional
+        The estimated Jaccard index of a pair to be kept. The default is 0.5.
+    num_perm : int, optional
+        Number of hash functions. The default is 128.
+    bands : int or None, optional
+        Number of bands, which should divide num_perm. More bands find more
+        similar pairs, at the cost of more candidates to compare. The default
+        is None, i.e. the fewest bands with which a pair with a Jaccard index
+        of cutoff becomes a candidate with probability >= 0.95.
+    seed : int, optional
+        Seed of the random hash functions. The default is 0.
+
+    Returns
+    -------
+    Sparse boolean terms x terms matrix of the similar pairs.
+
+    """
+    if bands is None:
+        bands = num_perm
+        for b in range(1, num_perm + 1):
+            if (num_perm % b == 0) and (1 - (1 - cutoff**(num_perm//b))**b >= 0.95):
+                bands = b
+                break
+    if num_perm % bands != 0:
+        raise ValueError('bands should divide num_perm')
+    membership, _, _ = enrich_utils._membership_matrix(gene_lists,
+                                                       genes,
+                                                       ngenes_thresh=0,
+                                                       terms=terms)
+    rng = np.random.default_rng(seed)
+    # Random ranks of the genes stand in for the hash functions
+    hashes = np.argsort(rng.random((num_perm, len(genes))), axis=1).astype(np.int32)
+
+    nterms = membership.shape[0]
+    signatures = np.full((nterms, num_perm), len(genes), dtype=np.int64)
+    nonempty = np.flatnonzero(np.diff(membership.indptr) > 0)
+    if len(nonempty) > 0:
+        # A few hash functions at a time, to bound the memory use
+        for k in range(0, num_perm, 16):
+            mins = np.minimum.reduceat(hashes[k:k + 16, membership.indices],
+                                       membership.indptr[:-1][nonempty],
+                                       axis=1)
+            signatures[nonempty, k:k + 16] = mins.T
+
+    # Candidate pairs of terms in the same bucket of any band. Empty sets are
+    # left out, since they should not be similar to each other
+    rows = num_perm//bands
+    candidates = []
+    pairs = {}
+    for b in range(bands if len(nonempty) > 1 else 0):
+        # The hashes of the band combined into one bucket key. Colliding keys
+        # only add candidates, which are compared below anyway
+        key = np.zeros(len(nonempty), dtype=np.uint64)
+        with np.errstate(over='ignore'):
+            for k in range(b*rows, (b + 1)*rows):
+                key = key*np.uint64(1000003) + signatures[nonempty, k].astype(np.uint64)
+        order = np.argsort(key)
+        starts = np.flatnonzero(np.diff(key[order]) != 0) + 1
+        starts = np.concatenate([[0], starts, [len(key)]])
+        sizes = np.diff(starts)
+        for start, size in zip(starts[:-1][sizes > 1], sizes[sizes > 1]):
+            if size not in pairs:
+                pairs[size] = np.triu_indices(size, k=1)
+            members = np.sort(nonempty[order[start:start + size]])
+            i, j = pairs[size]
+            candidates.append(members[i]*nterms + members[j])
+    if len(candidates) == 0:
+        return _neighbours(np.array([], dtype=int), np.array([], dtype=int), nterms)
+    candidates = np.unique(np.concatenate(candidates))
+    i, j = candidates//nterms, candidates % nterms
+
+    # The estimated Jaccard index of each candidate pair
+    sim = np.concatenate([
+        (signatures[i[k:k + 2**16]] == signatures[j[k:k + 2**16]]).mean(1)
+        for k in range(0, len(i), 2**16)
+        ])
+    similar = sim >= cutoff
+    return _neighbours(i[similar], j[similar], nterms)
+
+def _greedy_clusters(neighbours):
+    # Terms are taken in order (i.e. most significant first). Each term not
+    # yet clustered becomes a representative, and takes all its unclustered
+    # neighbours, i.e. terms with a similarity >= cutoff
+    nterms = neighbours.shape[0]
+    cluster = np.full(nterms, -1)
+    representative = np.full(nterms, -1)
+    n = 0
+    for i in range(nterms):
+        if cluster[i] >= 0:
+            continue
+        members = neighbours.indices[neighbours.indptr[i]:neighbours.indptr[i + 1]]
+        members = np.append(members[cluster[members] < 0], i)
+        cluster[members] = n
+        representative[members] = i
+        n += 1
+    return cluster, representative
+
+
+def cluster_terms(enrichments,
+                  gene_lists,
+                  target_genes=None,
+                  similarity='jaccard',
+                  cutoff=0.5,
+                  method='exact',
+                  only_FDR=True,
+                  ):
+    """
+    Redundancy reduction of enriched terms. Terms with similar member genes
+    are clustered, and each cluster is represented by its most significant
+    term.
+
+    Parameters
+    ----------
+    enrichments : pandas DataFrame
+        Results, as from enrich_utils.set_enrichments, sorted on p.
+    gene_lists : dict
+        The gene sets behind the enrichments.
+    target_genes : list or None, optional
+        If given, terms are compared on their overlap with the target genes
+        only, instead of on all their member genes. The default is None.
+    similarity : {'jaccard', 'overlap'}, optional
+        The similarity measure. The default is 'jaccard'.
+    cutoff : float, optional
+        Terms with a similarity >= cutoff to a representative term are
+        clustered with it. The default is 0.5.
+    method : {'exact', 'minhash'}, optional
+        Exact similarities from the sparse gene set memberships, or estimated
+        Jaccard indices from MinHash signatures for very large libraries.
+        'bitset' is accepted as an alias of 'exact'. The default is 'exact'.
+    only_FDR : bool, optional
+        If True, only cluster terms that passed the multiple testing
+        correction, which requires the column 'FDR'. The default is True.
+
+    Returns
+    -------
+    enrichments with the columns 'cluster' and 'representative' added. Terms
+    that were not clustered get cluster -1 and no representative.
+
+    """
+    enrichments = enrichments.copy()
+    terms = enrichments.index
+    if only_FDR:
+        if 'FDR' not in enrichments.columns:
+            raise ValueError('only_FDR=True requires the column "FDR" of a multiple testing correction')
+        terms = terms[enrichments.FDR.values.astype(bool)]
+
+    if target_genes is None:
+        genes = np.unique(np.concatenate(
+            [np.asarray(gene_lists[x]) for x in terms] + [np.array([], dtype=str)]
+            ))
+    else:
+        genes = np.unique(target_genes)
+
+    if method in ['exact', 'bitset']:
+        neighbours = _exact_neighbours(gene_lists,
+                                       terms,
+                                       genes,
+                                       similarity=similarity,
+                                       cutoff=cutoff)
+    elif method == 'minhash':
+        if similarity != 'jaccard':
+            raise ValueError('MinHash only estimates the "jaccard" similarity')
+        neighbours = _minhash_neighbours(gene_lists, terms, genes, cutoff=cutoff)
+    else:
+        raise ValueError('method should be either "exact" or "minhash"')
+
+    cluster, representative = _greedy_clusters(neighbours)
+
+    enrichments['cluster'] = -1
+    enrichments['representative'] = None
+    enrichments.loc[terms, 'cluster'] = cluster
+    enrichments.loc[terms, 'representative'] = np.asarray(terms)[representative]
+    return enrichments
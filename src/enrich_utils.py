@@ -1,7 +1,11 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import scipy.stats as sts
+import scipy.sparse as sparse
 import pandas as pd
 
+from src import stat_utils
 
 __author__ = 'Rasmus Magnusson'
 __COPYRIGHT__ = 'Copyright (C) 2020 Rasmus Magnusson'
@@ -19,15 +23,34 @@ def _sortsets(db):
     f.close()
     return gene_lists
 
-def _calc_fisher(gene_lists, genes_tmp, ngenes_thresh=10):
-    tmp = []
-    [tmp.append(gene_lists[x]) for x in gene_lists.keys()]
-    tmp.append(genes_tmp)
-    flat_list = np.array([item for sublist in tmp for item in sublist])
-    nunique = np.unique(flat_list).shape
+def _membership_matrix(gene_lists, genes, ngenes_thresh=10, terms=None):
+    # Sparse gene sets x genes matrix of which of 'genes' are in each gene
+    # set. Gene sets smaller than ngenes_thresh are left out
+    if terms is None:
+        terms = gene_lists
+    terms = [x for x in terms if len(gene_lists[x]) >= ngenes_thresh]
+    set_sizes = np.array([len(gene_lists[x]) for x in terms], dtype=int)
+
+    # All memberships in one flat lookup, rather than one per gene set
+    flat = np.concatenate([np.asarray(gene_lists[x]) for x in terms] + [np.array([], dtype=str)])
+    rows = np.repeat(np.arange(len(terms)), set_sizes)
+    cols = pd.Index(genes).get_indexer(flat)
+    found = cols >= 0
 
+    membership = sparse.csr_matrix((np.ones(found.sum()), (rows[found], cols[found])),
+                                   shape=(len(terms), len(genes)))
+    return membership, terms, set_sizes
 
-    # Fisher exact test
+def _universe(gene_lists):
+    # All genes annotated in any gene set. Hashed rather than sorted, which is
+    # much faster for large libraries
+    flat = np.concatenate([np.asarray(gene_lists[x], dtype=object) for x in gene_lists])
+    return np.sort(pd.unique(flat))
+
+def _fisher_arrays(A, set_sizes, ntargets, nunique):
+    # Vectorized one-sided Fisher exact test. A one-sided Fisher test is the
+    # hypergeometric tail
+    #
     #               | in disease genes | not disease gene
     #----------------------------------------------------
     # in light up   |         A        |        B
@@ -35,23 +58,310 @@ def _calc_fisher(gene_lists, genes_tmp, ngenes_thresh=10):
     # not light up  |         C        |        D
     #----------------------------------------------------
     #
-    OR = {}
-    p = {}
-    for hallmark in gene_lists:
-        if len(gene_lists[hallmark]) < ngenes_thresh:
-               continue
-        A = np.in1d(gene_lists[hallmark], genes_tmp).sum()
-        B = len(gene_lists[hallmark]) - A
-        C = len(genes_tmp) - A
-        D = nunique  - (A + B + C)
-
-        OR[hallmark], p[hallmark] = sts.fisher_exact([[A, B], [C, D]], alternative='greater')
-    res = pd.DataFrame([OR, p]).transpose()
-    res.columns = ['OR', 'p']
-    return res
+    A = np.asarray(A, dtype=float)
+    B = set_sizes - A
+    C = ntargets - A
+    D = nunique - (A + B + C)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        OR = (A*D)/(B*C)
+    p = stat_utils._hypergeom_sf(A, nunique, set_sizes, ntargets)
+    return OR, p
+
+# Built-in corrections that can also return adjusted p-values (q-values)
+_QVALUE_CORRECTIONS = (stat_utils.benjaminihochberg_correction,
+                       stat_utils.bonferroni_correction)
+
+# Built-in libraries, kept once loaded
+_gene_lists_cache = {}
 
+def _is_library(db):
+    # Whether db is a compiled library, as from compile_library, rather than
+    # a dict of gene sets
+    return isinstance(db, dict) and sparse.issparse(db.get('membership'))
 
-def set_enrichments(gene_set, mult_test_corr=None, db='GO', FDR=0.05, ):
+def _load_gene_lists(db):
+    pw = __file__.split('/src')[0]
+
+    if type(db) is not str:
+        return db['gene_lists'] if _is_library(db) else db
+    if db.upper() in _gene_lists_cache:
+        return _gene_lists_cache[db.upper()]
+
+    if db.upper()  == 'GO':
+        gene_lists = pd.read_pickle(pw + '/data/pickles/go_terms.p')
+    elif db.upper() == 'GWAS':
+        gene_lists = pd.read_pickle(pw + '/data/pickles/gwas.p')
+    elif (db.upper() == 'KEGG') or (db.upper() == 'REACTOME'):
+        # TODO: make this to a pickle too, and add 'ALL' as option for both
+        gene_lists = _sortsets(db)
+    else:
+        raise ValueError('db not specified correctly, should be either dict, or string with values "GO", "GWAS", "KEGG", or "REACTOME"')
+    _gene_lists_cache[db.upper()] = gene_lists
+    return gene_lists
+
+def _correct(p, mult_test_corr, FDR, axis=-1):
+    # Returns the pass mask, and the q-values if the correction supports it
+    if mult_test_corr in _QVALUE_CORRECTIONS:
+        return mult_test_corr(p, FDR=FDR, axis=axis, return_qvalues=True)
+    if axis == -1:
+        # User-defined corrections on 1-D p-values need not take an axis
+        return mult_test_corr(p, FDR=FDR), None
+    return mult_test_corr(p, FDR=FDR, axis=axis), None
+
+
+# Compiled built-in libraries, kept for later calls in the same process, with
+# the gene order they were compiled for. Each db has one slot for the default
+# gene order (genes=None), and one for the most recent given order, e.g. the
+# columns of the correlation matrix, so that the two do not evict each other
+_libraries = {}
+
+def _compile_library(gene_lists, genes=None, ngenes_thresh=10):
+    """
+    Integer encoding of a gene-set library for the array-native core. If
+    'genes' is given, e.g. the columns of the correlation matrix, these come
+    first in the gene order, so that their integer positions carry over.
+
+    Returns
+    -------
+    dict with the genes (pandas Index), the sparse gene sets x genes
+    membership in csr and csc form, the gene set names and sizes, the size of
+    the annotated universe, which genes are in it, and the gene sets it was
+    compiled from.
+
+    """
+    universe = _universe(gene_lists)
+    if genes is None:
+        genes = pd.Index(universe)
+    else:
+        genes = pd.Index(genes)
+        genes = genes.append(pd.Index(universe).difference(genes))
+
+    membership, terms, set_sizes = _membership_matrix(gene_lists,
+                                                      genes,
+                                                      ngenes_thresh=ngenes_thresh)
+    return {'genes': genes,
+            'membership': membership,
+            'membership_csc': membership.tocsc(),
+            'terms': np.array(terms, dtype=object),
+            'set_sizes': set_sizes,
+            'n_universe': len(universe),
+            'in_universe': genes.isin(universe),
+            'gene_lists': gene_lists,
+            }
+
+def compile_library(db, genes=None):
+    """
+    Compile a gene-set library once, for repeated queries. The result can be
+    passed as db to set_enrichments, batch_enrichments,
+    set_preranked_enrichments and TFTenricher.downstream_enrich, or as
+    library to set_enrichments. A dict passed as such is otherwise hashed on
+    every call, to check that it has not changed, which dominates the
+    queries of very large libraries. Compile again if the gene sets change.
+
+    Parameters
+    ----------
+    db : str or dict
+        As in set_enrichments.
+    genes : list or None, optional
+        Genes to put first in the gene order, e.g. the columns of the
+        correlation matrix for method='preranked' in TFTenricher. Libraries
+        with another order are then compiled again. The default is None.
+
+    Returns
+    -------
+    The compiled library.
+
+    """
+    if type(db) is str:
+        return _get_library(db, genes=genes)
+    return _compile_library(_load_gene_lists(db), genes=genes)
+
+def _fingerprint(gene_lists):
+    # Hash of the contents of a gene-set dict, so that a dict changed in place
+    # is recompiled. Much cheaper than compiling for large libraries
+    parts = []
+    for term, genes in gene_lists.items():
+        if isinstance(genes, np.ndarray) and genes.dtype.kind in 'US':
+            parts.append((term, genes.dtype.str, len(genes), hash(genes.tobytes())))
+        elif isinstance(genes, np.ndarray):
+            parts.append((term, hash(tuple(genes.tolist()))))
+        else:
+            parts.append((term, hash(tuple(genes))))
+    return hash(tuple(parts))
+
+def _get_library(db, genes=None, gene_lists=None):
+    # Libraries are compiled once per gene order. For dicts, only the most
+    # recent one is kept per slot, matched on its contents. Compiled libraries
+    # are used as they are, unless another gene order is asked for. gene_lists
+    # can be given if db is already loaded
+    if _is_library(db):
+        if (genes is None) or db['genes'][:len(genes)].equals(pd.Index(genes)):
+            return db
+        db = db['gene_lists']
+    if type(db) is not str:
+        key = ('dict', genes is None)
+        fingerprint = _fingerprint(db)
+        cached = _libraries.get(key)
+        if (cached is None) or (cached[0] != fingerprint) or (cached[1] is not genes):
+            _libraries[key] = (fingerprint, genes, _compile_library(db, genes=genes))
+        return _libraries[key][2]
+    key = (db.upper(), genes is None)
+    if (key not in _libraries) or (_libraries[key][0] is not genes):
+        if gene_lists is None:
+            gene_lists = _load_gene_lists(db)
+        _libraries[key] = (genes, _compile_library(gene_lists, genes=genes))
+    return _libraries[key][1]
+
+def _encode_genes(library, gene_set):
+    # Integer positions of the (unique) genes, and the number of genes not in
+    # the library
+    gene_set = pd.unique(np.asarray(gene_set, dtype=object))
+    idx = library['genes'].get_indexer(gene_set)
+    return idx[idx >= 0], int(np.sum(idx < 0))
+
+def _overlap_core(library, target_idx):
+    # The number of target genes in each gene set, i.e. A of the Fisher table
+    x = np.zeros(len(library['genes']))
+    x[target_idx] = 1
+    return library['membership'] @ x
+
+def _update_overlap_core(library, A, added_idx=(), removed_idx=()):
+    # Only the columns of the added and removed genes are read
+    csc = library['membership_csc']
+    A = A + np.asarray(csc[:, added_idx].sum(1)).ravel()
+    return A - np.asarray(csc[:, removed_idx].sum(1)).ravel()
+
+def _fisher_core(library, target_idx, n_unknown=0, A=None):
+    # OR and p of every gene set in the library, from integer encoded targets.
+    # Targets outside the annotated genes add to the universe, as do unknown
+    # genes
+    if A is None:
+        A = _overlap_core(library, target_idx)
+    ntargets = len(target_idx) + n_unknown
+    nunique = library['n_universe'] + n_unknown + np.sum(~library['in_universe'][target_idx])
+    return _fisher_arrays(A, library['set_sizes'], ntargets, nunique)
+
+def _fisher_runs(library, targets, n_unknown=0):
+    # As _fisher_core, for several runs at once. targets is a sparse runs x
+    # genes matrix of integer encoded targets, and the overlaps of all runs
+    # are one sparse product
+    A = (library['membership'] @ targets.T).T.toarray()
+    n_unknown = np.asarray(n_unknown)
+    ntargets = np.asarray(targets.sum(1)).ravel() + n_unknown
+    nunique = library['n_universe'] + n_unknown + targets @ (~library['in_universe']).astype(float)
+    return _fisher_arrays(A, library['set_sizes'][None, :], ntargets[:, None], nunique[:, None])
+
+def _encode_runs(library, gene_sets):
+    # Sparse runs x genes matrix of the (unique) genes of each run found in
+    # the library, and the number of genes of each run that are not
+    encoded = [_encode_genes(library, gene_set) for gene_set in gene_sets]
+    idx = [x[0] for x in encoded]
+    rows = np.repeat(np.arange(len(idx)), [len(x) for x in idx])
+    cols = np.concatenate(idx + [np.array([], dtype=int)])
+    targets = sparse.csr_matrix((np.ones(len(cols)), (rows, cols)),
+                                shape=(len(idx), len(library['genes'])))
+    return targets, np.array([x[1] for x in encoded])
+
+def _sub_library(library, rows):
+    # The library restricted to some of its gene sets, sharing the gene
+    # encoding
+    sub = {key: library[key] for key in library if key != 'shards'}
+    sub['membership'] = library['membership'][rows]
+    sub['terms'] = library['terms'][rows]
+    sub['set_sizes'] = library['set_sizes'][rows]
+    return sub
+
+# Term shards of large libraries are scored in parallel in a thread pool,
+# which is kept between calls. The numpy and scipy work of each shard
+# releases the GIL
+SHARD_SIZE = 20000
+_pool = None
+_pool_workers = None
+
+def _get_pool(n_workers):
+    global _pool, _pool_workers
+    if (_pool is None) or (_pool_workers != n_workers):
+        if _pool is not None:
+            _pool.shutdown(wait=False)
+        _pool = ThreadPoolExecutor(max_workers=n_workers)
+        _pool_workers = n_workers
+    return _pool
+
+def _shard_library(library, shard_size=SHARD_SIZE):
+    # Sub-libraries of consecutive gene sets, sharing the gene encoding. Kept
+    # in the library, so that they are only built once
+    shards = library.setdefault('shards', {})
+    if shard_size not in shards:
+        nterms = len(library['terms'])
+        shards[shard_size] = []
+        for start in range(0, nterms, shard_size):
+            stop = min(start + shard_size, nterms)
+            shards[shard_size].append((start, stop, _sub_library(library, slice(start, stop))))
+    return shards[shard_size]
+
+def _map_shards(library, score, n_workers=1, shard_size=SHARD_SIZE):
+    # score(sub_library, start, stop) of the whole library, or of its shards
+    # in parallel, merged along the gene sets (last axis) before any multiple
+    # testing correction
+    if (n_workers <= 1) or (len(library['terms']) <= shard_size):
+        return score(library, 0, len(library['terms']))
+
+    res = list(_get_pool(n_workers).map(lambda shard: score(shard[2], shard[0], shard[1]),
+                                        _shard_library(library, shard_size)))
+    OR = np.concatenate([r[0] for r in res], axis=-1)
+    p = np.concatenate([r[1] for r in res], axis=-1)
+    return OR, p
+
+def _fisher_core_parallel(library, target_idx, n_unknown=0, A=None, n_workers=1,
+                          shard_size=SHARD_SIZE):
+    # As _fisher_core, with the gene sets split in shards scored in parallel
+    def score(sub, start, stop):
+        sub_A = None if A is None else A[start:stop]
+        return _fisher_core(sub, target_idx, n_unknown=n_unknown, A=sub_A)
+    return _map_shards(library, score, n_workers=n_workers, shard_size=shard_size)
+
+def _enrich_core(library, target_idx, n_unknown=0, mult_test_corr=None, FDR=0.05, A=None,
+                 n_workers=1):
+    """
+    The array-native enrichment core. No DataFrames are built here. If
+    n_workers > 1, libraries of more than SHARD_SIZE gene sets are scored in
+    parallel shards.
+
+    Returns
+    -------
+    order : np.array
+        Positions of the gene sets in library['terms'], sorted on p.
+    OR, p : np.array
+        In the order of 'order'.
+    passes, q : np.array or None
+        The multiple testing correction, in the order of 'order'. None if
+        mult_test_corr is None, or (q only) does not return q-values.
+
+    """
+    OR, p = _fisher_core_parallel(library,
+                                  target_idx,
+                                  n_unknown=n_unknown,
+                                  A=A,
+                                  n_workers=n_workers)
+    order = np.argsort(p)
+    OR = OR[order]
+    p = p[order]
+
+    passes, q = None, None
+    if not mult_test_corr is None:
+        passes, q = _correct(p, mult_test_corr, FDR)
+    return order, OR, p, passes, q
+
+
+def set_enrichments(gene_set,
+                    mult_test_corr=None,
+                    db='GO',
+                    FDR=0.05,
+                    overlaps=None,
+                    library=None,
+                    n_workers=1,
+                    ):
     """
 
 
@@ -61,39 +371,210 @@ def set_enrichments(gene_set, mult_test_corr=None, db='GO', FDR=0.05, ):
         DESCRIPTION.
     db : str
         suggestions include, but are not limited to
-        {'REACTOME', 'KEGG', 'GO', GWAS}. The default is GO
+        {'REACTOME', 'KEGG', 'GO', GWAS}, or a dict, or a library from
+        compile_library. The default is GO
     FDR : float, optional
         False discovey rate acc BenjaminiHochberg. 0 < FDR < 1. The default is 0.05.
+    overlaps : np.array or None, optional
+        Precomputed number of genes in gene_set per gene set, in the order of
+        library['terms'], as from _overlap_core. If None, these are computed.
+        The default is None.
+    library : dict or None, optional
+        Compiled library, as from _compile_library. If given, db is not used.
+        The default is None.
+    n_workers : int, optional
+        Number of threads. Libraries with more than SHARD_SIZE gene sets, e.g.
+        large custom dicts, are split in shards that are scored in parallel.
+        The default is 1.
 
     Returns
     -------
-    enrichment analysis .
+    enrichment analysis. If mult_test_corr is one of the built-in corrections,
+    the adjusted p-values are added in the column 'q'.
 
     """
+    if library is None:
+        library = _get_library(db)
 
-    pw = __file__.split('/src')[0]
+    target_idx, n_unknown = _encode_genes(library, gene_set)
+    order, OR, p, passes, q = _enrich_core(library,
+                                           target_idx,
+                                           n_unknown=n_unknown,
+                                           mult_test_corr=mult_test_corr,
+                                           FDR=FDR,
+                                           A=overlaps,
+                                           n_workers=n_workers)
 
-    if type(db) is not str:
-        gene_lists = db
-    elif db.upper()  == 'GO':
-        gene_lists = pd.read_pickle(pw + '/data/pickles/go_terms.p')
-    elif db.upper() == 'GWAS':
-        gene_lists = pd.read_pickle(pw + '/data/pickles/gwas.p')
-    elif (db.upper() == 'KEGG') or (db.upper() == 'REACTOME'):
-        # TODO: make this to a pickle too, and add 'ALL' as option for both
-        gene_lists = _sortsets(db)
-    else:
-        raise ValueError('db not specified correctly, should be either dict, or string with values "GO", "GWAS", "KEGG", or "REACTOME"')
+    # The only DataFrame of the call
+    res = {'OR': OR, 'p': p}
+    if passes is not None:
+        res['FDR'] = passes
+    if q is not None:
+        res['q'] = q
+    return pd.DataFrame(res, index=library['terms'][order])
+
+
+def enrichment_matrix(targets, library, terms=None):
+    """
+    Fisher exact tests of several target gene sets at once, against a
+    compiled library.
+
+    Parameters
+    ----------
+    targets : pandas DataFrame
+        Boolean runs x genes matrix, True where a gene is a target in a run.
+    library : dict
+        Compiled library, as from _get_library. The universe of genes is
+        that of the library, plus any target genes outside it.
+    terms : list or None, optional
+        Only test these gene sets of the library. The default is None, i.e.
+        all gene sets.
+
+    Returns
+    -------
+    OR, p : pandas DataFrames
+        runs x gene sets matrices.
+
+    """
+    if terms is not None:
+        rows = pd.Index(library['terms']).get_indexer(terms)
+        library = _sub_library(library, rows[rows >= 0])
 
+    # Targets among the genes of the library, and the number of others
+    cols = library['genes'].get_indexer(targets.columns)
+    found = cols >= 0
+    rows, idx = np.nonzero(targets.values[:, found])
+    target_arr = sparse.csr_matrix((np.ones(len(rows)), (rows, cols[found][idx])),
+                                   shape=(targets.shape[0], len(library['genes'])))
+    n_unknown = targets.values[:, ~found].sum(1)
 
+    OR, p = _fisher_runs(library, target_arr, n_unknown=n_unknown)
+    OR = pd.DataFrame(OR, index=targets.index, columns=library['terms'])
+    p = pd.DataFrame(p, index=targets.index, columns=library['terms'])
+    return OR, p
 
-    res = _calc_fisher(gene_lists, gene_set)
 
-    index_sort = np.argsort(res.p)
+def batch_enrichments(gene_sets,
+                      mult_test_corr=stat_utils.benjaminihochberg_correction,
+                      db='GO',
+                      FDR=0.05,
+                      global_FDR=False,
+                      n_workers=1,
+                      ):
+    """
+    Enrichment of several target gene sets against the same database, with
+    the multiple testing correction done on the full runs x terms p-value
+    matrix in one pass.
+
+    Parameters
+    ----------
+    gene_sets : dict
+        Run names as keys, and target genes as elements.
+    mult_test_corr : function, optional
+        The multiple testing correction. Must accept a 2-D array and an 'axis'
+        keyword. The default is stat_utils.benjaminihochberg_correction.
+    db : str or dict, optional
+        As in set_enrichments. The default is 'GO'.
+    FDR : float, optional
+        False discovey rate. The default is 0.05.
+    global_FDR : bool, optional
+        If True, correct over all runs and terms together, instead of within
+        each run. The default is False.
+    n_workers : int, optional
+        As in set_enrichments. The default is 1.
+
+    Returns
+    -------
+    OR, p, q, passes_FDR : pandas DataFrames
+        runs x terms matrices. q is None if the correction does not return
+        adjusted p-values.
+
+    """
+    library = _get_library(db)
+
+    # All runs in one sparse product
+    targets, n_unknown = _encode_runs(library, [gene_sets[run] for run in gene_sets])
+    OR, p = _map_shards(library,
+                        lambda sub, start, stop: _fisher_runs(sub, targets, n_unknown=n_unknown),
+                        n_workers=n_workers)
+    OR = pd.DataFrame(OR, index=list(gene_sets), columns=library['terms'])
+    p = pd.DataFrame(p, index=list(gene_sets), columns=library['terms'])
+
+    axis = None if global_FDR else 1
+    passes, q = _correct(p.values, mult_test_corr, FDR, axis=axis)
+    if q is not None:
+        q = pd.DataFrame(q, index=p.index, columns=p.columns)
+    passes = pd.DataFrame(passes, index=p.index, columns=p.columns)
+    return OR, p, q, passes
+
+
+def _mannwhitney_arrays(ranks, membership, tie_term):
+    # Vectorized one-sided Mann-Whitney U test of the genes in each gene set
+    # against all other genes, from one sparse product of the rank vector.
+    # Normal approximation, with tie and continuity correction
+    N = len(ranks)
+    n1 = np.asarray(membership.sum(1)).ravel()
+    n2 = N - n1
+    R1 = membership @ ranks
+
+    U = R1 - n1*(n1 + 1)/2
+    sd = np.sqrt(n1*n2/12*((N + 1) - tie_term/(N*(N - 1))))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = (U - n1*n2/2 - 0.5)/sd
+        AUC = U/(n1*n2)
+    p = sts.norm.sf(z)
+    p[(n1 == 0) | (n2 == 0)] = 1
+    return AUC, p
+
+def set_preranked_enrichments(scores,
+                              mult_test_corr=None,
+                              db='GO',
+                              FDR=0.05,
+                              membership=None,
+                              ):
+    """
+    Threshold-free enrichment over continuous target scores. For each gene
+    set, a one-sided Mann-Whitney U test tests whether its genes have higher
+    scores than the other genes. All gene sets are tested at once from the
+    ranks of the scores.
+
+    Parameters
+    ----------
+    scores : pandas Series
+        Score per gene, e.g. the summed correlation from
+        map2trgt_utils.correlation_genes. All genes in scores make up the
+        background.
+    mult_test_corr, db, FDR :
+        As in set_enrichments.
+    membership : tuple or None, optional
+        Precompiled gene set membership, as from
+        _membership_matrix(gene_lists, scores.index). If None, it is built
+        here. The default is None.
+
+    Returns
+    -------
+    enrichment analysis, with the area under the ROC curve of each gene set
+    in the column 'AUC', i.e. the probability that a gene in the set scores
+    higher than a gene outside it.
+
+    """
+    if membership is None:
+        membership = _membership_matrix(_load_gene_lists(db), scores.index)
+    membership, terms, _ = membership
+
+    ranks = sts.rankdata(scores.values)
+    _, counts = np.unique(scores.values, return_counts=True)
+    tie_term = np.sum(counts.astype(float)**3 - counts)
+
+    AUC, p = _mannwhitney_arrays(ranks, membership, tie_term)
+    res = pd.DataFrame({'AUC': AUC, 'p': p}, index=terms)
+
+    index_sort = np.argsort(res.p.values, kind='stable')
     res = res.iloc[index_sort, :]
 
     if not mult_test_corr is None:
-            res['FDR'] = mult_test_corr(res.p, FDR=FDR)
+        passes, q = _correct(res.p, mult_test_corr, FDR)
+        res['FDR'] = passes
+        if q is not None:
+            res['q'] = q
     return res
-
-
@@ -1,3 +1,5 @@
+import os.path
+
 import pandas as pd
 import numpy as np
 
@@ -57,7 +59,182 @@ def trrust_genes(TFs, weighted=False, silent=False, top_n_genes=None):
     return targets
 
 
-def correlation_genes(TFs, thresh=0.95, silent=False, top_n_genes=None):
+# The correlation matrix is kept once loaded, so that later calls in the same
+# process, e.g. incremental TF updates, do not reload it
+_corr = None
+
+# Precomputed null cutoffs, a pandas DataFrame with the number of TFs as index
+# and thresh as columns
+NULL_TABLE = '/data/pickles/null_cutoffs.p'
+_null_table = None
+
+# Number of random TF sets of the null. The cutoff is the largest of their
+# quantiles, so it gets stricter with more sets, and the table and the Monte
+# Carlo estimate must use the same number to agree
+NULL_NPERMUT = 40
+
+# The column of each TF row of the correlation matrix (-1 if none). The
+# absolute correlations are taken of the few rows read, rather than kept as
+# a second copy of the matrix
+_tf_col = None
+
+def _load_corr(silent=False):
+    global _corr
+    if _corr is None:
+        pw = __file__.split('/src')[0]
+        if not silent:
+            print('loading corr')
+        _corr = pd.read_pickle(pw + '/data/pickles/correlations.p')
+        if not silent:
+            print('Done')
+    return _corr
+
+def _load_null_table():
+    # The precomputed null cutoffs, if built with build_corrmat.build_null_table
+    global _null_table
+    if _null_table is None:
+        pw = __file__.split('/src')[0]
+        if os.path.isfile(pw + NULL_TABLE):
+            _null_table = pd.read_pickle(pw + NULL_TABLE)
+    return _null_table
+
+def _tf_cols():
+    global _tf_col
+    if _tf_col is None:
+        corr = _load_corr(silent=True)
+        _tf_col = corr.columns.get_indexer(corr.index)
+    return _tf_col
+
+def _encode_tfs(TFs):
+    # Integer rows of the TFs found in the correlation matrix, and integer
+    # columns of all TFs found among the genes
+    corr = _load_corr(silent=True)
+    TFs = pd.unique(np.asarray(TFs, dtype=object))
+    rows = corr.index.get_indexer(TFs)
+    cols = corr.columns.get_indexer(TFs)
+    return rows[rows >= 0], cols[cols >= 0]
+
+def _score_core(rows):
+    # Summed absolute correlation of the TF rows, over all genes
+    return np.abs(_load_corr(silent=True).values[rows]).sum(0)
+
+def _target_core(scores, exclude_cols, nTFs, thresh=0.95, top_n_genes=None, cutoffs=None):
+    # Integer columns of the target genes. Since the self-correlation is one,
+    # the input TFs are removed from the set
+    keep = np.ones(len(scores), dtype=bool)
+    keep[exclude_cols] = False
+    idx = np.flatnonzero(keep)
+
+    if top_n_genes is not None:
+        return idx[np.argsort(scores[idx])[::-1][:top_n_genes]]
+
+    if thresh == -1:
+        return idx
+
+    cutoff = _get_cutoff(_load_corr(silent=True), nTFs, thresh=thresh, cutoffs=cutoffs)
+    return idx[scores[idx] >= cutoff]
+
+def _null_cutoff(corr, nTFs, thresh=0.95):
+    values = corr.values
+    tf_col = _tf_cols()
+    cval_dist = []
+    for _ in range(NULL_NPERMUT):
+        # Same draws as np.random.choice(corr.index, ...)
+        randrows = np.random.choice(corr.shape[0], size=nTFs, replace=False)
+        keep = np.ones(values.shape[1], dtype=bool)
+        keep[tf_col[randrows][tf_col[randrows] >= 0]] = False
+        ctmp = np.abs(values[randrows])[:, keep].sum(0)
+        cval_dist.append(np.sort(ctmp)[int(len(ctmp)*thresh)])
+    return np.max(cval_dist)
+
+def _get_cutoff(corr, nTFs, thresh=0.95, cutoffs=None):
+    # Look up the cutoff in the precomputed table if possible, and otherwise
+    # estimate it by Monte Carlo. Either way, it is cached in 'cutoffs'
+    if cutoffs is None:
+        cutoffs = {}
+    if nTFs not in cutoffs:
+        table = _load_null_table()
+        if (table is not None) and (thresh in table.columns) and (nTFs in table.index) \
+                and not np.isnan(table.loc[nTFs, thresh]):
+            cutoffs[nTFs] = table.loc[nTFs, thresh]
+        else:
+            cutoffs[nTFs] = _null_cutoff(corr, nTFs, thresh=thresh)
+    return cutoffs[nTFs]
+
+def null_cutoff_table(corr, thresh=0.95, Npermut=NULL_NPERMUT, max_TFs=None, seed=0):
+    """
+    The Monte Carlo null cutoff of correlation_genes for every number of TFs
+    from 1 to max_TFs. The cutoff only depends on the number of TFs, so it can
+    be computed once. For each permutation, the TFs are drawn in random order
+    and the rows are summed cumulatively, which gives the null for all sizes
+    in one pass.
+
+    Parameters
+    ----------
+    corr : pandas DataFrame
+        The TFs x genes correlation matrix.
+    thresh : float, optional
+        As in correlation_genes. The default is 0.95.
+    Npermut : int, optional
+        Number of random TF orders. As in the Monte Carlo estimate, the cutoff
+        is the largest quantile over these, so more orders give stricter
+        cutoffs than the estimate used without a table. The default is
+        NULL_NPERMUT, i.e. 40, which matches the estimate.
+    max_TFs : int or None, optional
+        The largest number of TFs. The default is None, i.e. all TFs in corr.
+    seed : int, optional
+        Seed of the random number generator. The default is 0.
+
+    Returns
+    -------
+    pandas Series of cutoffs, indexed by the number of TFs.
+
+    """
+    rng = np.random.default_rng(seed)
+    values = corr.values
+    nall = values.shape[0]
+    if max_TFs is None:
+        max_TFs = nall
+    max_TFs = min(max_TFs, nall)
+
+    # The column of each TF, which is removed from the genes when drawn
+    tf_col = corr.columns.get_indexer(corr.index)
+
+    cutoffs = np.full(max_TFs, -np.inf)
+    for _ in range(Npermut):
+        running = np.zeros(values.shape[1])
+        excluded = np.zeros(values.shape[1], dtype=bool)
+        for n, row in enumerate(rng.permutation(nall)[:max_TFs]):
+            running += np.abs(values[row])
+            if tf_col[row] >= 0:
+                excluded[tf_col[row]] = True
+            vals = running[~excluded]
+            k = int(len(vals)*thresh)
+            cutoffs[n] = max(cutoffs[n], np.partition(vals, k)[k])
+    return pd.Series(cutoffs, index=np.arange(1, max_TFs + 1))
+
+def _threshold_scores(scores, TFs, thresh=0.95, top_n_genes=None, cutoffs=None):
+    rows, cols = _encode_tfs(TFs)
+    if len(rows) == 0:
+        raise Exception('No input TFs are in correlation matrix')
+
+    idx = _target_core(scores.values,
+                       cols,
+                       len(rows),
+                       thresh=thresh,
+                       top_n_genes=top_n_genes,
+                       cutoffs=cutoffs)
+    if top_n_genes is not None:
+        return scores.index[idx]
+    return scores.index.values[idx]
+
+
+def correlation_genes(TFs,
+                      thresh=0.95,
+                      silent=False,
+                      top_n_genes=None,
+                      return_scores=False,
+                      cutoffs=None):
     """
 
 
@@ -65,53 +242,128 @@ def correlation_genes(TFs, thresh=0.95, silent=False, top_n_genes=None):
     ----------
     TFs : list
         List of transcription factors to map to target genes..
+    return_scores : bool, optional
+        If True, also return the summed correlation of all genes, including
+        the input TFs, which can be updated with update_correlation_scores.
+        The default is False.
+    cutoffs : dict or None, optional
+        Cache of null cutoffs keyed by the number of TFs found. Filled in
+        place. The default is None.
 
     Returns
     -------
     Panda series of correlating target genes summed over TFs.
 
     """
+    corr = _load_corr(silent=silent)
 
-    pw = __file__.split('/src')[0]
-    if not silent:
-        print('loading corr')
-    corr = pd.read_pickle(pw + '/data/pickles/correlations.p')
-    if not silent:
-        print('Done')
-
-
-    in_TFs = corr.index.isin(TFs)
-    in_corr = np.in1d(TFs, corr.index)
-
-    if in_corr.sum() == 0:
+    rows, _ = _encode_tfs(TFs)
+    if len(rows) == 0:
         raise Exception('No input TFs are in correlation matrix')
 
 
     if not silent:
+        in_corr = np.in1d(TFs, corr.index)
         print(str(100*np.sum(~in_corr)/len(in_corr)) + '% of TFs are not found')
-        print(str(100*np.sum(in_TFs)/len(in_TFs))[:5] + '% of correlation table TFs were in the TF list')
+        print(str(100*len(rows)/corr.shape[0])[:5] + '% of correlation table TFs were in the TF list')
+
+    scores = pd.Series(_score_core(rows), index=corr.columns)
+    target_genes = _threshold_scores(scores,
+                                     TFs,
+                                     thresh=thresh,
+                                     top_n_genes=top_n_genes,
+                                     cutoffs=cutoffs,
+                                     )
+    if return_scores:
+        return target_genes, scores
+    return target_genes
+
+def update_correlation_scores(scores, TFs, sign=1):
+    """
+    Since the summed correlation is additive over TFs, TFs can be added to
+    (sign=1) or removed from (sign=-1) the scores from correlation_genes by
+    reading only their rows of the correlation matrix.
 
+    Parameters
+    ----------
+    scores : pandas Series
+        Summed correlation, as returned by correlation_genes with
+        return_scores=True.
+    TFs : list
+        The TFs to add or remove. These should not already be, or still be,
+        part of the scores, respectively.
+    sign : {1, -1}, optional
+        Whether to add or remove the TFs. The default is 1.
 
-    # Since the self-correlation is one, we need to remove the input TFs from
-    # the set
-    corr_out = corr.iloc[:, ~corr.columns.isin(TFs)]
-    target_genes = corr_out[in_TFs].abs().sum()
+    Returns
+    -------
+    The updated scores.
 
-    if top_n_genes is not None:
-        return target_genes.sort_values()[::-1][:top_n_genes].index
+    """
+    rows, _ = _encode_tfs(TFs)
+    return scores + sign*_score_core(rows)
 
-    if thresh == -1:
-        return target_genes.index.values
 
-    cval_dist = []
-    for _ in range(40):
-        randtfs = np.random.choice(corr.index, size=(in_corr.sum()), replace=False)
-        ctmp = corr.iloc[:, ~corr.columns.isin(randtfs)][corr.index.isin(randtfs)].abs().sum()
-        cval_dist.append(np.sort(ctmp)[int(len(ctmp)*thresh)])
+def leave_one_out_targets(scores, TFs, thresh=0.95, top_n_genes=None, cutoffs=None):
+    """
+    Target genes when leaving out each TF in turn. Since the summed
+    correlation is additive over TFs, all leave-one-out scores are the total
+    scores minus one row of the correlation matrix, and are thresholded
+    together.
 
-    target_genes_adj = target_genes[target_genes >= np.max(cval_dist)]
-    return target_genes_adj.index.values
+    Parameters
+    ----------
+    scores : pandas Series
+        Summed correlation, as returned by correlation_genes with
+        return_scores=True.
+    TFs : list
+        The TFs behind the scores.
+    thresh, top_n_genes, cutoffs :
+        As in correlation_genes.
 
+    Returns
+    -------
+    targets : pandas DataFrame
+        Boolean TFs x genes matrix, True where a gene is a target when the TF
+        is left out. Only TFs found in the correlation matrix are included.
+
+    contributions : pandas DataFrame
+        TFs x genes matrix of the absolute correlation each TF adds to the
+        scores.
+
+    """
+    corr = _load_corr(silent=True)
+    rows = np.flatnonzero(corr.index.isin(TFs))
+    contributions = pd.DataFrame(np.abs(corr.values[rows]),
+                                 index=corr.index[rows],
+                                 columns=corr.columns)
+    found = contributions.index.values
+    nTFs = len(found)
+    if nTFs < 2:
+        raise Exception('At least two input TFs must be in the correlation matrix')
+
+    loo = scores.values[None, :] - contributions.values
+
+    # The input TFs are removed from the targets, except for the TF that is
+    # left out in each row
+    is_TF = scores.index.isin(TFs)
+    keep = np.tile(~is_TF, (nTFs, 1))
+    col = scores.index.get_indexer(found)
+    keep[np.arange(nTFs)[col >= 0], col[col >= 0]] = True
+    loo[~keep] = -np.inf
+
+    if top_n_genes is not None:
+        top_n_genes = min(top_n_genes, keep.sum(1).min())
+        top = np.argpartition(-loo, top_n_genes - 1, axis=1)[:, :top_n_genes]
+        targets = np.zeros(loo.shape, dtype=bool)
+        np.put_along_axis(targets, top, True, axis=1)
+    elif thresh == -1:
+        targets = keep
+    else:
+        targets = loo >= _get_cutoff(corr, nTFs - 1, thresh=thresh, cutoffs=cutoffs)
+
+    targets = pd.DataFrame(targets, index=found, columns=scores.index)
+    return targets, contributions
 
 
 def STRING_ppi(TFs, FDR=0.95, Npermut=100, silent=False, top_n_genes=None):
@@ -1,6 +1,8 @@
 
 import argparse
 
+from src import map2trgt_utils
+
 __author__ = 'Rasmus Magnusson'
 __COPYRIGHT__ = 'Copyright (C) 2020 Rasmus Magnusson'
 __contact__ = 'rasma774@gmail.com'
@@ -88,5 +90,142 @@ def parse():
     return parser.parse_args()
 
 
+def parse_shard():
+    DESC = """Run large screens of TF lists sharded over several nodes that
+    share a filesystem.
+
+    1. 'coordinate' splits a manifest of TF lists into shards in a shared
+       directory.
+    2. 'work' claims shards and runs them. Start any number of workers, on
+       any node.
+    3. 'merge' combines the results, and re-runs jobs that are missing or
+       failed.
+
+    Shards of workers that crashed are moved back by 'requeue', or by any
+    worker that runs out of pending shards, once their lease has expired.
+
+    Each line of the manifest is one TF list, optionally preceded by a job id
+    and a tab.
+
+    Further reference:
+        - https://github.com/rasma774/TFTenricher
+    """
+    parser = argparse.ArgumentParser(description=DESC)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    coordinate = subparsers.add_parser('coordinate', help='Write the job shards')
+    coordinate.add_argument('--manifest',
+                            type=str,
+                            nargs=1,
+                            required=True,
+                            help='Text file with one TF list per line')
+    coordinate.add_argument('--sep',
+                            default=[' '],
+                            type=str,
+                            nargs=1,
+                            help='Separator of the TFs in the manifest. Default is one blank space')
+    coordinate.add_argument('--shard_size',
+                            default=[100],
+                            type=int,
+                            nargs=1,
+                            help='Number of TF lists per shard')
+    coordinate.add_argument('--db',
+                            type=str,
+                            nargs='*',
+                            default=['GO'],
+                            help='What to compare the putative target genes to. Any of\n\
+                            {"KEGG", "REACTOME", "GO", "GWAS"}')
+    coordinate.add_argument('--multiple_test_corr',
+                            default=['BenjaminiHochberg'],
+                            type=str,
+                            nargs=1,
+                            help='Multiple testing correction function. Either BenjaminiHochberg or Bonferroni.')
+    coordinate.add_argument('--ngenes',
+                            default=[None],
+                            type=int,
+                            nargs=1,
+                            help='Number of top target genes to be analysed. Default is\n\
+                                to use built-in monte carlo estimation')
+    coordinate.add_argument('--FDR',
+                            default=[.05],
+                            type=float,
+                            nargs=1,
+                            help='Set the FDR for enrichment analysis')
+    coordinate.add_argument('--overwrite',
+                            action='store_true',
+                            help='Remove the shards and results of an earlier screen in shard_dir')
+
+    work = subparsers.add_parser('work', help='Claim and run shards until none are left')
+    work.add_argument('--worker_id',
+                      default=[None],
+                      type=str,
+                      nargs=1,
+                      help='Name of the worker. Default is host name and pid')
+
+    requeue = subparsers.add_parser('requeue', help='Move stale claimed shards back to pending')
+
+    merge = subparsers.add_parser('merge', help='Merge the results of all shards')
+    merge.add_argument('--results_savename',
+                       type=str,
+                       default=['results.csv'],
+                       nargs=1,
+                       help='The name of the file to which the merged results are saved')
+    merge.add_argument('--no_rerun',
+                       action='store_true',
+                       help='Do not re-run missing or failed jobs')
+
+    for sub in [work, requeue]:
+        sub.add_argument('--lease',
+                         default=[3600],
+                         type=float,
+                         nargs=1,
+                         help='Seconds without a finished job before a claimed shard is\n\
+                             requeued. Default is 3600')
+
+    for sub in [coordinate, work, requeue, merge]:
+        sub.add_argument('--shard_dir',
+                         type=str,
+                         nargs=1,
+                         required=True,
+                         help='Directory on a filesystem shared by all nodes')
+
+    return parser.parse_args()
+
+
+def parse_null_table():
+    DESC = """Precompute the null cutoffs of the correlation based target
+    mapping for every number of TFs, and store them with the correlation
+    matrix. Run from the TFTenricher directory as
+    python -m src.build_corrmat
+
+    Further reference:
+        - https://github.com/rasma774/TFTenricher
+    """
+    parser = argparse.ArgumentParser(description=DESC)
+    parser.add_argument('--thresh',
+                        default=[0.95],
+                        type=float,
+                        nargs=1,
+                        help='Quantile of the null distribution used as cutoff. Default is 0.95')
+    parser.add_argument('--Npermut',
+                        default=[map2trgt_utils.NULL_NPERMUT],
+                        type=int,
+                        nargs=1,
+                        help='Number of random TF sets per size. More sets give stricter\n\
+                            cutoffs. Default is ' + str(map2trgt_utils.NULL_NPERMUT) +
+                            ', as in the estimate without a table')
+    parser.add_argument('--max_TFs',
+                        default=[None],
+                        type=int,
+                        nargs=1,
+                        help='The largest number of TFs. Default is all TFs in the correlation matrix')
+    parser.add_argument('--seed',
+                        default=[0],
+                        type=int,
+                        nargs=1,
+                        help='Seed of the random number generator. Default is 0')
+    return parser.parse_args()
+
+
 if __name__ == '__main__':
     parse()
@@ -71,6 +71,11 @@ def plot_res(enrichments,
     else:
         nplot = np.min((plot_Ntop, enrichments.shape[0]))
         
+    # The effect size is 'OR', or 'AUC' for preranked enrichments
+    effect = enrichments.columns[0]
+    if sorton == 'OR':
+        sorton = effect
+
     # Clean input data
     enrichments = enrichments.iloc[:, :2]
     enrichments.p = -np.log10(enrichments.p)
@@ -90,12 +95,12 @@ def plot_res(enrichments,
     
     
     for i in range(nplot):
-        ax.barh(padding*(nplot - i), width=enrichments.OR[i], height=0.4, color=cmap(norm(enrichments.p[i])))    
+        ax.barh(padding*(nplot - i), width=enrichments[effect][i], height=0.4, color=cmap(norm(enrichments.p[i])))    
     
-    ax.set_xlim([0, enrichments.OR[:i].max()*1.2])
+    ax.set_xlim([0, enrichments[effect][:i].max()*1.2])
     ax.set_yticks(padding*np.array(range(1, 1 + nplot)))
     ax.set_yticklabels(enrichments.index[:plot_Ntop][::-1])
-    ax.set_xlabel('Odds Ratio', fontsize=17)
+    ax.set_xlabel('Odds Ratio' if effect == 'OR' else effect, fontsize=17)
     colorbar = f.colorbar(mpl.cm.ScalarMappable(norm=norm, cmap=cmap), ax=ax, shrink=0.4, pad = 0.15)
     colorbar.set_label(r'-log$_{10}$ P', fontsize=15, labelpad=-50)
     
@@ -0,0 +1,385 @@
+import json
+import os
+import os.path
+import shutil
+import socket
+import time
+import traceback
+
+import pandas as pd
+
+__author__ = 'Rasmus Magnusson'
+__COPYRIGHT__ = 'Copyright (C) 2021 Rasmus Magnusson'
+__contact__ = 'rasma774@gmail.com'
+
+# Layout of a shard directory, which should be on a filesystem shared by all
+# nodes. Shards move from PENDING to CLAIMED to DONE by os.rename, which is
+# atomic, so that a shard is only ever claimed by one worker. A claimed
+# shard is touched after every job, and shards not touched within LEASE
+# seconds, e.g. of crashed workers, can be moved back to PENDING by requeue
+CONFIG = 'config.json'
+MANIFEST = 'manifest.json'
+PENDING = 'pending'
+CLAIMED = 'claimed'
+DONE = 'done'
+RESULTS = 'results'
+RERUN = 'rerun_'
+LEASE = 3600
+
+RESULT_COLUMNS = ['job_id', 'term', 'db', 'OR', 'p', 'FDR', 'q']
+
+
+def read_manifest(path, sep=' '):
+    """
+    Read a manifest of TF lists. Each line is one job, either as
+    'job_id<TAB>TFs' or only the TFs, in which case the line number is used
+    as job id.
+
+    Parameters
+    ----------
+    path : str
+        Path to the manifest.
+    sep : str, optional
+        Separator between the TFs. The default is one blank space.
+
+    Returns
+    -------
+    dict with job ids as keys and lists of TFs as elements.
+
+    """
+    jobs = {}
+    with open(path, 'r') as f:
+        for i, line in enumerate(f):
+            line = line.strip('\n')
+            if len(line) == 0:
+                continue
+            if '\t' in line:
+                job_id, line = line.split('\t', 1)
+            else:
+                job_id = str(i)
+            if job_id in jobs:
+                raise ValueError('Job id ' + job_id + ' is not unique in the manifest')
+            jobs[job_id] = [tf for tf in line.split(sep) if len(tf) > 0]
+    return jobs
+
+def _tmp_path(path):
+    # Files are written to a temporary file first, so that readers never see
+    # a partial file. The name is unique per host and process, since a
+    # requeued shard can be run by two workers at once
+    return path + '.tmp.' + socket.gethostname() + '_' + str(os.getpid())
+
+def _write_json(obj, path):
+    tmp = _tmp_path(path)
+    with open(tmp, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp, path)
+
+def _write_csv(res, path):
+    tmp = _tmp_path(path)
+    res.to_csv(tmp, index=False)
+    os.replace(tmp, path)
+
+def _read_json(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def write_shards(jobs,
+                 shard_dir,
+                 shard_size=100,
+                 db=('GO',),
+                 FDR=0.05,
+                 multiple_test_corr='BenjaminiHochberg',
+                 ngenes=None,
+                 overwrite=False,
+                 ):
+    """
+    Coordinator step. Split the jobs into shards in shard_dir, for workers to
+    claim. Since job ids are only unique within a screen, shard_dir should
+    not hold an earlier screen, whose results would otherwise be merged
+    with the new ones.
+
+    Parameters
+    ----------
+    jobs : dict
+        Job ids as keys and lists of TFs as elements, as from read_manifest.
+    shard_dir : str
+        Directory on a shared filesystem.
+    shard_size : int, optional
+        Number of jobs per shard. The default is 100.
+    db : list, optional
+        The databases to enrich each TF list in. The default is ('GO',).
+    FDR, multiple_test_corr, ngenes :
+        As in TFTenricher and TFTenricher.downstream_enrich.
+    overwrite : bool, optional
+        If shard_dir holds an earlier screen, remove its shards and results
+        instead of raising an error. The default is False.
+
+    Returns
+    -------
+    The number of shards written.
+
+    """
+    subs = [PENDING, CLAIMED, DONE, RESULTS]
+    earlier = [x for x in subs if os.path.isdir(os.path.join(shard_dir, x))
+               and len(os.listdir(os.path.join(shard_dir, x))) > 0]
+    earlier += [x for x in [CONFIG, MANIFEST] if os.path.isfile(os.path.join(shard_dir, x))]
+    if len(earlier) > 0:
+        if not overwrite:
+            raise ValueError(shard_dir + ' already holds a screen (' + ', '.join(earlier) +
+                             '). Use another directory, or overwrite it (overwrite=True, or --overwrite)')
+        for sub in subs:
+            shutil.rmtree(os.path.join(shard_dir, sub), ignore_errors=True)
+
+    for sub in subs:
+        os.makedirs(os.path.join(shard_dir, sub), exist_ok=True)
+
+    config = {'db': list(db),
+              'FDR': FDR,
+              'multiple_test_corr': multiple_test_corr,
+              'ngenes': ngenes,
+              }
+    _write_json(config, os.path.join(shard_dir, CONFIG))
+    _write_json(jobs, os.path.join(shard_dir, MANIFEST))
+
+    job_ids = list(jobs)
+    nshards = 0
+    for start in range(0, len(job_ids), shard_size):
+        shard = {job_id: jobs[job_id] for job_id in job_ids[start:start + shard_size]}
+        name = 'shard_' + str(nshards).zfill(6) + '.json'
+        _write_json(shard, os.path.join(shard_dir, PENDING, name))
+        nshards += 1
+    return nshards
+
+def run_job(TFs, config):
+    """
+    Run the normal TFTenricher pipeline for one TF list, in all databases of
+    the config.
+
+    Returns
+    -------
+    pandas DataFrame with one row per database and term.
+
+    """
+    # Imported here, since TFTenricher itself imports the src modules
+    from TFTenricher import TFTenricher
+
+    enr = TFTenricher(TFs, silent=True, top_n_genes=config['ngenes'])
+    res = []
+    for db in config['db']:
+        enr.downstream_enrich(db=db,
+                              FDR=config['FDR'],
+                              multiple_testing_correction=config['multiple_test_corr'],
+                              )
+        tmp = enr.enrichments.copy()
+        tmp.insert(0, 'db', db)
+        res.append(tmp)
+    res = pd.concat(res)
+    res.index.name = 'term'
+    return res.reset_index()
+
+def _claim(shard_dir, worker_id):
+    # Returns the path of a claimed shard, or None if there are no shards left
+    pending = os.path.join(shard_dir, PENDING)
+    for name in sorted(os.listdir(pending)):
+        if not name.endswith('.json'):
+            continue
+        claimed = os.path.join(shard_dir, CLAIMED, name[:-5] + '.' + worker_id + '.json')
+        try:
+            os.rename(os.path.join(pending, name), claimed)
+        except FileNotFoundError:
+            # Another worker got there first
+            continue
+        _touch(claimed)
+        return claimed
+    return None
+
+def _touch(claimed):
+    # Renew the lease of a claimed shard. If it has been requeued, another
+    # worker may run it too, which only overwrites the results with the same
+    try:
+        os.utime(claimed)
+    except FileNotFoundError:
+        pass
+
+def requeue(shard_dir, lease=LEASE):
+    """
+    Move claimed shards that have not been touched for 'lease' seconds, e.g.
+    of crashed workers, back to pending, so that other workers can claim
+    them.
+
+    Parameters
+    ----------
+    shard_dir : str
+        The directory written by write_shards.
+    lease : float, optional
+        Seconds since the last finished job of a shard before it is
+        considered stale. Should be well above the run time of one job. The
+        default is LEASE, i.e. one hour.
+
+    Returns
+    -------
+    The number of shards requeued.
+
+    """
+    claimed_dir = os.path.join(shard_dir, CLAIMED)
+    now = time.time()
+    nrequeued = 0
+    for name in sorted(os.listdir(claimed_dir)):
+        if not name.endswith('.json'):
+            continue
+        claimed = os.path.join(claimed_dir, name)
+        try:
+            if now - os.path.getmtime(claimed) < lease:
+                continue
+            os.rename(claimed, os.path.join(shard_dir, PENDING, name.split('.')[0] + '.json'))
+        except FileNotFoundError:
+            # Finished, or requeued by someone else, in the meantime
+            continue
+        nrequeued += 1
+    return nrequeued
+
+def work(shard_dir, worker_id=None, max_shards=None, lease=LEASE):
+    """
+    Worker step. Claim shards until none are left, and write the results of
+    each shard to the results directory. Jobs that fail are recorded together
+    with the error, and can be re-run at the merge step.
+
+    Parameters
+    ----------
+    shard_dir : str
+        The directory written by write_shards.
+    worker_id : str or None, optional
+        Name of this worker. The default is None, i.e. host name and pid.
+    max_shards : int or None, optional
+        Stop after this many shards. The default is None.
+    lease : float or None, optional
+        When no shards are pending, requeue shards with a lease older than
+        this, as in requeue, and keep working. If None, stale shards are
+        left. The default is LEASE.
+
+    Returns
+    -------
+    The number of shards run.
+
+    """
+    if worker_id is None:
+        worker_id = socket.gethostname() + '_' + str(os.getpid())
+    config = _read_json(os.path.join(shard_dir, CONFIG))
+
+    nrun = 0
+    while (max_shards is None) or (nrun < max_shards):
+        claimed = _claim(shard_dir, worker_id)
+        if claimed is None:
+            if (lease is not None) and (requeue(shard_dir, lease=lease) > 0):
+                continue
+            break
+        shard = _read_json(claimed)
+        name = os.path.basename(claimed).split('.')[0]
+
+        res = []
+        failed = {}
+        for job_id in shard:
+            try:
+                tmp = run_job(shard[job_id], config)
+                tmp.insert(0, 'job_id', job_id)
+                res.append(tmp)
+            except Exception:
+                failed[job_id] = traceback.format_exc()
+            # Renew the lease after every job, also failed ones
+            _touch(claimed)
+
+        if len(res) > 0:
+            res = pd.concat(res)
+        else:
+            res = pd.DataFrame(columns=RESULT_COLUMNS)
+        _write_csv(res, os.path.join(shard_dir, RESULTS, name + '.csv'))
+        _write_json(failed, os.path.join(shard_dir, RESULTS, name + '.failed.json'))
+
+        try:
+            os.replace(claimed, os.path.join(shard_dir, DONE, os.path.basename(claimed)))
+        except FileNotFoundError:
+            # Requeued while running, and possibly claimed again
+            pass
+        nrun += 1
+    return nrun
+
+def merge(shard_dir, savename=None, rerun=True):
+    """
+    Merge step. Combine the partial results of all shards. Jobs that failed,
+    or whose shard never finished, are re-run here, and their results are
+    saved in the results directory so that later merges do not re-run them.
+    Should be run when all workers are done, since jobs of shards still
+    running count as missing. Stale shards can instead be requeued for the
+    workers with requeue.
+
+    Parameters
+    ----------
+    shard_dir : str
+        The directory written by write_shards.
+    savename : str or None, optional
+        If given, save the merged results as csv to this path. The default is
+        None.
+    rerun : bool, optional
+        Whether to re-run missing and failed jobs. The default is True.
+
+    Returns
+    -------
+    results : pandas DataFrame
+        All results, with the job id in the column 'job_id'.
+
+    missing : list
+        Job ids without results, e.g. if they failed again on re-run.
+
+    """
+    config = _read_json(os.path.join(shard_dir, CONFIG))
+    jobs = _read_json(os.path.join(shard_dir, MANIFEST))
+
+    res_dir = os.path.join(shard_dir, RESULTS)
+    res = []
+    finished = set()
+    for name in sorted(os.listdir(res_dir)):
+        if not name.endswith('.failed.json'):
+            continue
+        shard = name[:-len('.failed.json')]
+        failed = _read_json(os.path.join(res_dir, name))
+        tmp = pd.read_csv(os.path.join(res_dir, shard + '.csv'), dtype={'job_id': str})
+        res.append(tmp)
+        finished.update(set(tmp.job_id) - set(failed))
+
+    # Jobs re-run by earlier merges, unless their shard has since finished
+    for name in sorted(os.listdir(res_dir)):
+        if not (name.startswith(RERUN) and name.endswith('.csv')):
+            continue
+        tmp = pd.read_csv(os.path.join(res_dir, name), dtype={'job_id': str})
+        tmp = tmp[~tmp.job_id.isin(finished)]
+        res.append(tmp)
+        finished.update(set(tmp.job_id))
+
+    missing = [job_id for job_id in jobs if job_id not in finished]
+    if rerun:
+        still_missing = []
+        rerun_res = []
+        for job_id in missing:
+            try:
+                tmp = run_job(jobs[job_id], config)
+            except Exception:
+                still_missing.append(job_id)
+                continue
+            tmp.insert(0, 'job_id', job_id)
+            rerun_res.append(tmp)
+        missing = still_missing
+
+        if len(rerun_res) > 0:
+            rerun_res = pd.concat(rerun_res)
+            name = RERUN + time.strftime('%Y%m%d_%H%M%S') + '_' + str(os.getpid()) + '.csv'
+            _write_csv(rerun_res, os.path.join(res_dir, name))
+            res.append(rerun_res)
+
+    if len(res) > 0:
+        res = pd.concat(res, ignore_index=True)
+    else:
+        res = pd.DataFrame(columns=RESULT_COLUMNS)
+
+    if savename is not None:
+        res.to_csv(savename, index=False)
+    return res, missing
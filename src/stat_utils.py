@@ -1,40 +1,84 @@
 import numpy as np
 import scipy.stats as sts
+from scipy.special import gammaln
 
 __author__ = 'Rasmus Magnusson'
 __COPYRIGHT__ = 'Copyright (C) 2020 Rasmus Magnusson'
 __contact__ = 'rasma774@gmail.com'
 
-def benjaminihochberg_correction(p, FDR=0.05):
+def _sort_along(p, axis):
+    # Flatten if axis is None, so that the correction is done globally over all
+    # tests, e.g. a global FDR over all runs in a runs x terms matrix
+    p = np.asarray(p, dtype=float)
+    if axis is None:
+        return p.reshape(-1), -1
+    return p, axis
+
+
+def benjaminihochberg_correction(p, FDR=0.05, axis=-1, return_qvalues=False):
     """
 
 
     Parameters
     ----------
     p : np.array
-        array of p-values of independent tests.
+        array of p-values of independent tests. If p is 2-D, e.g. runs x terms,
+        each run is corrected separately along 'axis' in one sorted pass.
     FDR : float, optional
         False discovey rate. 0 < FDR < 1. The default is 0.05.
+    axis : int or None, optional
+        The axis along which the tests are corrected. If None, all p-values
+        are corrected together, i.e. a global FDR across all runs. The default
+        is -1.
+    return_qvalues : bool, optional
+        If True, also return the BH-adjusted p-values (q-values). The default
+        is False.
 
     Returns
     -------
     passes_FDR
-        A vector of same length as input parameter p, with bool value True
+        An array of same shape as input parameter p, with bool value True
         where the test passed a BH FDR correction.
 
+    q : np.array
+        Only returned if return_qvalues is True. The BH-adjusted p-values, of
+        same shape as p.
+
     """
-    sorted_p = np.sort(p)
-    rank = np.arange(1, len(p)+1)
+    shape = np.shape(p)
+    p, axis = _sort_along(p, axis)
+
+    order = np.argsort(p, axis=axis)
+    sorted_p = np.take_along_axis(p, order, axis=axis)
+
+    m = sorted_p.shape[axis]
+    rank_shape = [1]*sorted_p.ndim
+    rank_shape[axis] = m
+    rank = np.arange(1, m + 1).reshape(rank_shape)
+
+    # A test passes if any test of higher or equal rank is below its critical
+    # value, i.e. a reversed cumulative any along the axis
+    BH_crit = (rank/m)*FDR
+    below = np.flip(sorted_p < BH_crit, axis=axis)
+    sorted_pass = np.flip(np.logical_or.accumulate(below, axis=axis), axis=axis)
 
-    BH_crit = (rank/rank[-1])*FDR
+    passes_FDR = np.empty_like(sorted_pass)
+    np.put_along_axis(passes_FDR, order, sorted_pass, axis=axis)
+    passes_FDR = passes_FDR.reshape(shape)
 
-    if np.any(sorted_p < BH_crit):
-        thresh = sorted_p[sorted_p < BH_crit][-1]
-        return p <= thresh
-    else:
-        return p < 0
+    if not return_qvalues:
+        return passes_FDR
 
-def bonferroni_correction(p, FDR=0.05):
+    # q_i = min_{k >= i} p_k*m/k, capped at 1
+    q_sorted = np.flip(sorted_p*m/rank, axis=axis)
+    q_sorted = np.flip(np.minimum.accumulate(q_sorted, axis=axis), axis=axis)
+    q_sorted = np.minimum(q_sorted, 1)
+
+    q = np.empty_like(q_sorted)
+    np.put_along_axis(q, order, q_sorted, axis=axis)
+    return passes_FDR, q.reshape(shape)
+
+def bonferroni_correction(p, FDR=0.05, axis=-1, return_qvalues=False):
     """
     Bonferroni correction for multiple testing. Takes in a vector of p-values
     and returns true where p_i < alpha_corrected, where alpha_corrected = 0.05/N
@@ -43,7 +87,14 @@ def bonferroni_correction(p, FDR=0.05):
     Parameters
     ----------
     p : list or numpy array
-        Probabilities of independent statistical tests stored in a vector.
+        Probabilities of independent statistical tests stored in a vector, or
+        in a 2-D array of e.g. runs x terms.
+    axis : int or None, optional
+        The axis along which N is counted. If None, N is the total number of
+        tests in p. The default is -1.
+    return_qvalues : bool, optional
+        If True, also return the Bonferroni-adjusted p-values. The default is
+        False.
 
     Returns
     -------
@@ -51,13 +102,96 @@ def bonferroni_correction(p, FDR=0.05):
         A boolean vector of same shape as p where True indicates that the test
         passed a bonferroni correction.
 
+    p_adj : numpy array
+        Only returned if return_qvalues is True. min(p*N, 1), of same shape as
+        p.
+
     See Also
     --------
     stat_utils.benjaminihochberg_correction : often less stringent test correction
 
     """
-    return np.array(p) < (FDR/len(p))
+    shape = np.shape(p)
+    p, axis = _sort_along(p, axis)
+    N = p.shape[axis]
+
+    passes = (p < (FDR/N)).reshape(shape)
+    if not return_qvalues:
+        return passes
+    return passes, np.minimum(p*N, 1).reshape(shape)
+
+
+def _log_binom(a, b):
+    return gammaln(a + 1) - gammaln(b + 1) - gammaln(a - b + 1)
 
+def _hypergeom_sf(k, M, n, N, tol=1e-17):
+    """
+    Vectorized hypergeometric tail P(X >= k), i.e. the one-sided Fisher exact
+    test, for many tests at once. Same as scipy.stats.hypergeom.sf(k - 1, M,
+    n, N), but without a Python loop per test.
+
+    The pmf is log-concave, so the terms decrease away from the mode. Above
+    the mode, the upper tail is summed from k and up by the pmf recurrence.
+    Below it, the lower tail is summed from k - 1 and down, and subtracted
+    from one. Both sums stop once the terms no longer add to the sum.
+
+    Parameters
+    ----------
+    k, M, n, N : np.array
+        Broadcastable arrays of the observed count, the population size, the
+        number of successes in the population, and the number of draws.
+
+    Returns
+    -------
+    p : np.array
+        P(X >= k).
+
+    """
+    k, M, n, N = [np.array(x, dtype=float) for x in np.broadcast_arrays(k, M, n, N)]
+    lo = np.maximum(0, N - (M - n))
+    hi = np.minimum(n, N)
+    mode = np.floor((n + 1)*(N + 1)/(M + 2))
+    p = np.ones(k.shape)
+    p[k > hi] = 0
+
+    def logpmf(x):
+        return _log_binom(n, x) + _log_binom(M - n, N - x) - _log_binom(M, N)
+
+    # Upper tail, from k and up
+    upper = (k > mode) & (k <= hi)
+    x = k[upper]
+    nu, Nu, Mu, hu = n[upper], N[upper], M[upper], hi[upper]
+    term = np.ones(x.shape)
+    tail = np.ones(x.shape)
+    active = x < hu
+    while active.any():
+        xa = x[active]
+        term[active] *= (nu[active] - xa)*(Nu[active] - xa) \
+            / ((xa + 1)*(Mu[active] - nu[active] - Nu[active] + xa + 1))
+        tail[active] += term[active]
+        x[active] += 1
+        active &= (x < hu) & (term > tol*tail)
+    with np.errstate(invalid='ignore'):
+        p[upper] = np.exp(logpmf(k)[upper])*tail
+
+    # Lower tail, from k - 1 and down
+    lower = (k <= mode) & (k - 1 >= lo)
+    x = k[lower] - 1
+    nl, Nl, Ml, ll = n[lower], N[lower], M[lower], lo[lower]
+    term = np.ones(x.shape)
+    tail = np.ones(x.shape)
+    active = x > ll
+    while active.any():
+        xa = x[active]
+        term[active] *= xa*(Ml[active] - nl[active] - Nl[active] + xa) \
+            / ((nl[active] - xa + 1)*(Nl[active] - xa + 1))
+        tail[active] += term[active]
+        x[active] -= 1
+        active &= (x > ll) & (term > tol*tail)
+    with np.errstate(invalid='ignore'):
+        p[lower] = 1 - np.exp(logpmf(k - 1)[lower])*tail
+
+    return np.clip(p, 0, 1)
 
 def _stringdb_bootstrap(summed_score, ppi, nTFs, FDR=0.05, N=100):
     unique_string_tfs = ppi.index.unique()